@@ -17,24 +17,379 @@ python genPlaylist.py config1.cfg config2.cfg config3.cfg
 @TODO enhanced missing files from artists
 @TODO missing files from general
 """
-import configparser
+import functools
 import os
+import re
 import sys
 import random
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from itertools import islice
+from xml.sax.saxutils import escape
 from tinytag import TinyTag
 from tinytag.tinytag import TinyTagException
 
 # Keys to section fields
+# Keys are lowercased when the config file is parsed
 INCLUDE_KEY = "include"
 EXCLUDE_KEY = "exclude"
 RANDOM_KEY = "random"
-OUTPUT_PATH_KEY = "outputPath"
+DIRS_KEY = "dirs"
+OUTPUT_PATH_KEY = "outputpath"
+SEED_KEY = "seed"
+
+# Fields holding comma separated lists
+LIST_KEYS = (INCLUDE_KEY, EXCLUDE_KEY, DIRS_KEY)
 
 # Parts of the playlist file (.xspf)
 PLAYLIST_HEADERS = '<?xml version="1.0" encoding="UTF-8"?>\n<playlist version="1" xmlns="http://xspf.org/ns/0/">\n\t<trackList>\n'
 PLAYLIST_END = '\t</trackList>\n</playlist>'
 PLAYLIST_ENTRY_TEMPLATE = '\t\t<track><location>file:///{}</location><title>{}</title></track>\n'
 
+# Buffer size when writing the playlist file
+OUTPUT_BUFFER_SIZE = 1 << 20
+
+# Surrounding whitespace, then quotes, as removed by stripAll
+STRIP_RE = re.compile(r"^\s*['\"]*|['\"]*\s*$")
+
+# File extensions that TinyTag picks a tag parser for (see TinyTag._get_parser_for_filename)
+AUDIO_EXTENSIONS = frozenset({".mp1", ".mp2", ".mp3", ".oga", ".ogg", ".opus", ".wav", ".flac",
+                              ".wma", ".m4b", ".m4a", ".m4r", ".mp4",
+                              ".aiff", ".aifc", ".aif", ".afc"})
+
+# Number of files handed to each worker process at a time
+ARTIST_CHUNK_SIZE = 64
+
+# Number of files taken from the directory walk before their tags are read
+ARTIST_BATCH_SIZE = 1024
+
+# Artists of every file read so far, shared by all generators in this process
+# Maps absolute path of a file to the tuple returned by readArtist
+ARTIST_CACHE = {}
+
+
+def readArtist(filePath):
+    """
+    Get the artists' names from a file's tags.
+
+    Module-level so it can be sent to worker processes.
+    @param filePath: absolute path to the file in question
+    @return tuple of strings of the artist name(s),
+        or empty tuple if unable to get that information
+    """
+    try:
+        # Only the tags are needed, skip scanning the audio frames for the duration
+        tag = TinyTag.get(filePath, tags=True, duration=False, image=False)
+    except TinyTagException:
+        print("warning: could not get artist for {}".format(filePath))
+        return ()
+    if tag.artist is None:
+        return ()
+    return tuple(tag.artist.split("/"))
+
+
+def scanDirectories(directories):
+    """
+    Iterate through the entries of several directories as one iterator.
+
+    @param directories: iterable of paths of directories to scan
+    @return generator of os.DirEntry for every entry in each directory
+    """
+    for directory in directories:
+        with os.scandir(directory) as entries:
+            yield from entries
+
+
+def collectCandidates(directories, filePaths, excludePaths, excludeNames, readTags):
+    """
+    Find the files in directories that still need rules applied to them.
+
+    This loop runs for every file in the library. It only takes plain strings
+    and sets and doesn't use PlaylistGenerator or PlaylistWriter, so it can be
+    compiled on its own (Ex: with Cython) if it ever needs to be faster. Files
+    are yielded as the directories are walked rather than collected in a list.
+    @param directories: iterable of absolute paths of directories to scan
+    @param filePaths: set of absolute paths of files already added to the playlist
+    @param excludePaths: set of absolute paths of files to exclude from the playlist
+    @param excludeNames: set of names of files to exclude from the playlist
+    @param readTags: whether tags are needed at all
+    @return generator of (filename, filePath, hasTags) tuples in directory order,
+        where hasTags says whether the file's artists should be read
+    """
+    # Locals are quicker in the loop below
+    splitext = os.path.splitext
+
+    # Iterate through each file in all of the directories in a single loop
+    for entry in scanDirectories(directories):
+        # Skip non-files (Ex: subdirectories)
+        if not entry.is_file():
+            continue
+
+        # Entries are made from absolute directories, so their paths are absolute
+        filename = entry.name
+        filePath = entry.path
+
+        # Skip if this has already been added or should be excluded
+        # The directories are distinct absolute paths, so the walk itself never repeats a path
+        if filePath in filePaths or filePath in excludePaths or filename in excludeNames:
+            continue
+
+        # Only audio files have tags worth reading
+        hasTags = readTags and splitext(filename)[1].lower() in AUDIO_EXTENSIONS
+
+        yield filename, filePath, hasTags
+
+
+def readCandidateArtists(executor, candidates):
+    """
+    Read the artists of candidate files in worker processes, a batch at a time.
+
+    Only one batch of candidates is held at once, so the directory walk is
+    never materialized in full. Files already read for an earlier config come
+    from ARTIST_CACHE instead, and newly read ones are added to it.
+    @param executor: ProcessPoolExecutor to read tags in
+    @param candidates: iterable of (filename, filePath, hasTags) tuples
+    @return generator of (filename, filePath, artists) tuples in the same order
+    """
+    candidates = iter(candidates)
+    while True:
+        batch = list(islice(candidates, ARTIST_BATCH_SIZE))
+        if not batch:
+            return
+
+        tagPaths = [filePath for _, filePath, hasTags in batch
+                    if hasTags and filePath not in ARTIST_CACHE]
+        newArtists = executor.map(readArtist, tagPaths, chunksize=ARTIST_CHUNK_SIZE)
+        for filename, filePath, hasTags in batch:
+            if hasTags:
+                artists = ARTIST_CACHE.get(filePath)
+                if artists is None:
+                    artists = ARTIST_CACHE[filePath] = next(newArtists)
+            else:
+                artists = ()
+            yield filename, filePath, artists
+
+
+class FastConfigParser:
+    """
+    Minimal parser for the ini-style playlist config files.
+
+    Reads the file once into plain dicts so later lookups don't go through
+    configparser's mapping layer. Supports [section] headers, key = value or
+    key: value pairs, indented continuation lines and full-line comments
+    starting with # or ;. Keys are lowercased like configparser does.
+
+    As with configparser's default interpolation, keys in the DEFAULT section
+    are inherited by every other section, %% becomes % and %(key)s is replaced
+    by that key's value. Unlike configparser, a lone % or a reference to a
+    missing key is kept as written rather than raising an error.
+    """
+
+    # Same header pattern as configparser, anything after the last ] is ignored
+    SECTION_RE = re.compile(r"\[(.+)\]")
+    OPTION_RE = re.compile(r"^([^=:]+?)\s*[:=]\s*(.*)$")
+    INTERPOLATION_RE = re.compile(r"%%|%\(([^)]+)\)s")
+
+    # Same limit as configparser for references nested in references
+    MAX_INTERPOLATION_DEPTH = 10
+
+    def __init__(self, configFile):
+        """
+        Init.
+
+        @param configFile: string of path to config file
+        """
+        self.sections = {}
+        with open(configFile) as file:
+            self.parse(file)
+        self.applyDefaults()
+
+    def parse(self, lines):
+        """
+        Populate sections from lines of a config file.
+
+        @param lines: iterable of lines of the config file
+        """
+        section = None
+        key = None
+        for line in lines:
+            stripped = line.strip()
+
+            # Skip blank lines and comments
+            if not stripped or stripped[0] in "#;":
+                continue
+
+            # Indented lines continue the previous value
+            if line[0].isspace() and key is not None:
+                section[key] += "\n" + stripped
+                continue
+
+            match = self.SECTION_RE.match(stripped)
+            if match:
+                section = self.sections.setdefault(match.group(1), {})
+                key = None
+                continue
+
+            match = self.OPTION_RE.match(stripped)
+            if match and section is not None:
+                key = match.group(1).lower()
+                section[key] = match.group(2)
+            else:
+                # Drop whatever follows too, rather than merging it into the previous section
+                print("warning: ignoring config line {}".format(stripped))
+                section = None
+                key = None
+
+    def applyDefaults(self):
+        """Merge the DEFAULT section into every other section and interpolate values."""
+        defaults = self.sections.pop("DEFAULT", {})
+        for name, section in self.sections.items():
+            fields = {**defaults, **section}
+            self.sections[name] = {key: self.interpolate(value, fields)
+                                   for key, value in fields.items()}
+
+    def interpolate(self, value, fields, depth=0):
+        """
+        Expand %% and %(key)s in a value.
+
+        @param value: string of the raw value
+        @param fields: dict of the section's raw fields, including defaults
+        @param depth: number of references already followed to get here
+        @return string of the expanded value
+        """
+        if "%" not in value:
+            return value
+
+        def replace(match):
+            key = match.group(1)
+            if key is None:
+                return "%"
+            key = key.lower()
+            if key not in fields or depth >= self.MAX_INTERPOLATION_DEPTH:
+                return match.group(0)
+            return self.interpolate(fields[key], fields, depth + 1)
+
+        return self.INTERPOLATION_RE.sub(replace, value)
+
+
+@dataclass(slots=True)
+class ArtistRules:
+    """
+    Rules and state for the files of one artist.
+
+    These are whether or not all files should be added,
+    remaining names of files to be added,
+    names of files to exclude,
+    a list of (path, name) pairs of files to add afterwards,
+    and how many of those random files are requested
+    """
+
+    addAll: bool = False
+    fileNames: set = field(default_factory=set)
+    excludeNames: set = field(default_factory=set)
+    random: list = field(default_factory=list)
+    nRandom: int = 0
+    wantsRandom: bool = False
+
+
+class PlaylistWriter:
+    """
+    Streams entries to a playlist file as files are added.
+
+    Use as a context manager, which writes the headers on entry and the end
+    of the playlist on exit. Files are added with their absolute path and
+    name, but only the paths are kept to skip duplicates. That
+    set still grows with the playlist, so streaming saves the names and the
+    playlist text rather than making memory use constant.
+
+    Entries go to a temporary file next to the output, which only replaces
+    the output once the playlist is complete. If anything goes wrong first,
+    (Ex: an error or Ctrl-C), the temporary file is deleted and any previous
+    playlist is left untouched.
+    """
+
+    def __init__(self, outputPath):
+        """
+        Init.
+
+        @param outputPath: string of path to the playlist file to write
+        """
+        self.outputPath = outputPath
+        self.tempPath = None
+        self.outputFile = None
+        self.paths = set()
+
+    def __enter__(self):
+        """Open a temporary playlist file and write its headers."""
+        fd, self.tempPath = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(self.outputPath)),
+            prefix=".{}.".format(os.path.basename(self.outputPath)), suffix=".tmp")
+        try:
+            self.outputFile = open(fd, "w", encoding="utf-8", buffering=OUTPUT_BUFFER_SIZE)
+            self.outputFile.write(PLAYLIST_HEADERS)
+        except BaseException:
+            if self.outputFile is None:
+                os.close(fd)
+            self.discard()
+            raise
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        """Finish the playlist and move it over the output, or discard it on error."""
+        if excType is not None:
+            self.discard()
+            return
+
+        try:
+            self.outputFile.write(PLAYLIST_END)
+            self.outputFile.close()
+            os.chmod(self.tempPath, self.outputMode())
+            os.replace(self.tempPath, self.outputPath)
+        except BaseException:
+            self.discard()
+            raise
+
+    def outputMode(self):
+        """
+        Get the permissions the output file should have.
+
+        @return the mode of the existing output file, or the default mode
+            for new files if there is none yet
+        """
+        try:
+            return os.stat(self.outputPath).st_mode & 0o777
+        except OSError:
+            # mkstemp creates files only the owner can read, use the usual default instead
+            umask = os.umask(0)
+            os.umask(umask)
+            return 0o666 & ~umask
+
+    def discard(self):
+        """Close and delete the temporary playlist file."""
+        if self.outputFile is not None:
+            self.outputFile.close()
+        if os.path.exists(self.tempPath):
+            os.remove(self.tempPath)
+
+    def __contains__(self, filePath):
+        """Check if the file at the absolute path has been added."""
+        return filePath in self.paths
+
+    def add(self, filePath, fileName):
+        """
+        Add a file to the playlist unless it was already added.
+
+        @param filePath: absolute path of the file
+        @param fileName: name of the file
+        """
+        if filePath in self.paths:
+            return
+        self.paths.add(filePath)
+
+        # Paths and names are escaped so characters like & don't corrupt the XML
+        self.outputFile.write(PLAYLIST_ENTRY_TEMPLATE.format(escape(filePath), escape(fileName)))
+
 
 class SectionFiles:
     """
@@ -60,53 +415,61 @@ class PlaylistGenerator:
         @param configFile: string of path to config file
         """
         self.configFile = configFile
-        self.config = configparser.ConfigParser()
-        self.config.read(configFile)
+
+    @functools.cached_property
+    def sections(self):
+        """Dict of the config file's sections, parsed on first use."""
+        return FastConfigParser(self.configFile).sections
+
+    @functools.cached_property
+    def parsedLists(self):
+        """
+        Dict of each section's list fields, split and stripped once.
+
+        Maps section name to a dict mapping each list field to a tuple of its
+        non-empty entries with whitespace and quotes removed.
+        """
+        parsedLists = {}
+        for section, fields in self.sections.items():
+            parsedLists[section] = {}
+            for key in LIST_KEYS:
+                if key in fields:
+                    entries = (self.stripAll(entry) for entry in fields[key].split(","))
+                    parsedLists[section][key] = tuple(entry for entry in entries if entry)
+        return parsedLists
+
+    @functools.cached_property
+    def rng(self):
+        """Random number generator, seeded from the General section's seed field if given."""
+        return random.Random(self.sections.get("General", {}).get(SEED_KEY))
 
     def stripAll(self, string):
         """Strip whitespace and quotes."""
         if isinstance(string, str):
-            string = string.strip().strip("'\"")
+            string = STRIP_RE.sub("", string)
         return string
 
-    def getArtist(self, filePath):
-        """
-        Get the artists' names.
-
-        @param filePath: path to the file in question
-        @return list of strings of the artist name(s),
-            or empty list if unable to get that information
-        """
-        try:
-            tag = TinyTag.get(filePath)
-        except TinyTagException:
-            print("warning: could not get artist for {}".format(filePath))
-            return []
-        if tag.artist is None:
-            return []
-        return tag.artist.split("/")
-
-    def parseFileList(self, section, key, paths, names):
+    def parseFileList(self, section, key, names):
         """
         Parse list of files in section field.
 
-        Populates sets depending on if the element is a valid path or not
-        @param section: dict representing the section in question
+        Returns the elements that are valid paths and adds the rest to names
+        @param section: dict of the section's parsed list fields
         @param key: key to dict representing the field name
-        @param paths: set of absolute paths of files
         @param names: set of names of files
+        @return list of (absolute path, name) pairs of the files given by path
         """
-        if key in section:
-            # Iterate through each entry in include
-            for entry in section[key].strip().split(","):
-                # Strip whitespace and any quotations for paths
-                entry = self.stripAll(entry)
-
-                # Add file if it is a path, otherwise add it to fileNames
-                if os.path.isfile(entry):
-                    paths.add(os.path.abspath(entry))
-                elif entry != "":
-                    names.add(entry)
+        paths = []
+
+        # Iterate through each entry in the field
+        for entry in section.get(key, ()):
+            # Keep file if it is a path, otherwise add it to names
+            if os.path.isfile(entry):
+                paths.append((os.path.abspath(entry), os.path.basename(entry)))
+            else:
+                names.add(entry)
+
+        return paths
 
     def addSpecifiedFiles(self, section, filePaths, excludePaths, fileNames, excludeNames):
         """
@@ -117,29 +480,33 @@ class PlaylistGenerator:
         not yet reached.
 
         @param section: section to read from
-        @param filePaths: set of absolute paths of files to add to the playlist
+        @param filePaths: PlaylistWriter of files to add to the playlist
         @param excludedPaths: set of absolute paths of files to exclude from the playlist
         @param fileNames: set of names of files to add to the playlist
         @param excludeNames: set of names of files to exclude from the playlist
         """
         # Verify the section exists
-        if section not in self.config:
+        if section not in self.sections:
             return
 
         # Populate filePaths and fileNames
-        self.parseFileList(self.config[section], INCLUDE_KEY, filePaths, fileNames)
+        for filePath, fileName in self.parseFileList(self.parsedLists[section], INCLUDE_KEY,
+                                                     fileNames):
+            filePaths.add(filePath, fileName)
 
         # Populate excludePaths and excludeNames
-        self.parseFileList(self.config[section], EXCLUDE_KEY, excludePaths, excludeNames)
+        for filePath, _ in self.parseFileList(self.parsedLists[section], EXCLUDE_KEY,
+                                              excludeNames):
+            excludePaths.add(filePath)
 
     def getArtistRules(self, filePaths, excludePaths):
         """
-        Generate artist rules dict and process certain files in advance.
+        Generate artist rules and process certain files in advance.
 
-        @param filePaths: set of file paths added to the playlist
+        @param filePaths: PlaylistWriter of files added to the playlist
         @param excludedPaths: set of absolute paths of files to exclude from the playlist
-        @return dict mapping each artist to their respective rules and state.
-            this dict should also have a list that will contain absolute paths
+        @return dict mapping each artist to their respective ArtistRules.
+            these also have a list that will contain (absolute path, name) pairs
             of files to be randomly chosen if they are not otherwise selected
             or excluded
         """
@@ -147,31 +514,33 @@ class PlaylistGenerator:
         rules = {}
 
         # Iterate through each artist
-        for section in self.config.keys():
+        for section in self.sections.keys():
             # Skip General section
             if section == "General":
                 continue
 
-            # Create dict of rules for this artist
-            # These are whether or not all files should be added,
-            # remaining names of files to be added,
-            # names of files to exclude,
-            # and a list of paths of files to add afterwards
-            artistRules = {"addAll": False,
-                           "fileNames": set(),
-                           "excludeNames": set(),
-                           "random": []}
+            # Create rules for this artist
+            artistRules = ArtistRules()
 
             # Populate sets
             self.addSpecifiedFiles(section, filePaths, excludePaths,
-                                   artistRules["fileNames"], artistRules["excludeNames"])
+                                   artistRules.fileNames, artistRules.excludeNames)
 
             # Assume we want all files if include field is empty or missing
             # and no random number is specified
-            if ((INCLUDE_KEY not in self.config[section]
-                    or len(self.config[section][INCLUDE_KEY].strip()) == 0)
-                    and RANDOM_KEY not in self.config[section]):
-                artistRules["addAll"] = True
+            fields = self.sections[section]
+            if ((INCLUDE_KEY not in fields or len(fields[INCLUDE_KEY].strip()) == 0)
+                    and RANDOM_KEY not in fields):
+                artistRules.addAll = True
+
+            # Parse the number of random files once, up front
+            if RANDOM_KEY in fields:
+                try:
+                    artistRules.nRandom = int(fields[RANDOM_KEY])
+                    artistRules.wantsRandom = True
+                except ValueError:
+                    # Invalid random number
+                    print("error: invalid number of random files for {}".format(section))
 
             # Add to total rules dict
             rules[section] = artistRules
@@ -183,54 +552,27 @@ class PlaylistGenerator:
         Process file through respective artist rules.
 
         Add file to filePaths if rules allow.
-        @param rules: dict of the artist's rules
+        @param rules: ArtistRules of the artist
         @param artist: string of artist name
-        @param filePaths: set of absolute paths of files to add to the playlist
+        @param filePaths: PlaylistWriter of files to add to the playlist
         @param filename: name of file in question
         @param filePath: absolute path of file in question
         """
         # Check if file is excluded
-        if filename in rules["excludeNames"]:
+        if filename in rules.excludeNames:
             # File is excluded
             return
 
         # Check if file is included
-        if rules["addAll"] or filename in rules["fileNames"]:
-            filePaths.add(filePath)
+        if rules.addAll or filename in rules.fileNames:
+            filePaths.add(filePath, filename)
 
             # Remove filename from remaining files to add
-            if filename in rules["fileNames"]:
-                rules["fileNames"].remove(filename)
+            if filename in rules.fileNames:
+                rules.fileNames.remove(filename)
         else:
             # Not specified - add to random pile for later
-            rules["random"].append(filePath)
-
-    def writeToPlaylist(self, filePaths):
-        """
-        Write to playlist file.
-
-        @param filePaths: list of files' absolute paths to write to playlist
-        """
-        # Verify that the output path exists
-        if "General" not in self.config or OUTPUT_PATH_KEY not in self.config["General"]:
-            print("error: can't find output file path in General section")
-            return
-
-        # Write playlist file
-        with open(self.config["General"][OUTPUT_PATH_KEY], "w+") as outputFile:
-            # Write headers
-            outputFile.write(PLAYLIST_HEADERS)
-
-            # Write all of the files
-            for filePath in filePaths:
-                # Get name of file
-                fileName = os.path.basename(filePath)
-
-                # Write entry
-                outputFile.write(PLAYLIST_ENTRY_TEMPLATE.format(filePath, fileName))
-
-            # Write end of playlist file
-            outputFile.write(PLAYLIST_END)
+            rules.random.append((filePath, filename))
 
     def genPlaylist(self):
         """
@@ -239,106 +581,101 @@ class PlaylistGenerator:
         @return 0 if successful, 1 otherwise
         """
         print('Starting {}'.format(self.configFile))
-        # Set of absolute paths of files to add to the playlist
-        filePaths = set()
-
-        # Set of absolute paths of files to exclude from filePaths
-        excludePaths = set()
-
-        # Set of names of files to add to or exclude from filePaths
-        fileNames = set()
-        excludeNames = set()
-
-        # List of random general files' absolute paths to add later if dictated
-        randomGeneral = []
 
-        # Create rules specific to artists
-        # Also adds files with their paths specified in the artist sections
-        artistRules = self.getArtistRules(filePaths, excludePaths)
-
-        # Add any files with their paths specified in general section
-        # Also update the excluded paths for General
-        self.addSpecifiedFiles("General", filePaths, excludePaths, fileNames, excludeNames)
-
-        # Go through each file in general directories
-        if "dirs" in self.config["General"]:
-            for directory in self.config["General"]["dirs"].strip().split(","):
-                # Strip away any whitespace or quotation marks
-                directory = self.stripAll(directory)
-
-                # Check that this is a valid directory
-                if not os.path.isdir(directory):
-                    # Skip invalid directory
-                    print("error: invalid directory {}".format(directory))
-                    continue
-
-                # Iterate through each file in this directory
-                for filename in os.listdir(directory):
-                    # Get the absolute path
-                    filePath = os.path.abspath(os.path.join(directory, filename))
-
-                    # Skip non-files (Ex: subdirectories)
-                    if not os.path.isfile(filePath):
-                        continue
+        # Verify that the output path exists
+        if "General" not in self.sections or OUTPUT_PATH_KEY not in self.sections["General"]:
+            print("error: can't find output file path in General section")
+            return
 
-                    # Skip if this has already been added or should be excluded
-                    if (filePath in filePaths or filePath in excludePaths
-                            or filename in excludeNames):
+        # Files are written to the playlist as soon as they are added to filePaths
+        with PlaylistWriter(self.sections["General"][OUTPUT_PATH_KEY]) as filePaths:
+            # Set of absolute paths of files to exclude from filePaths
+            excludePaths = set()
+
+            # Set of names of files to add to or exclude from filePaths
+            fileNames = set()
+            excludeNames = set()
+
+            # List of random general files' (absolute path, name) pairs to add later if dictated
+            randomGeneral = []
+
+            # Create rules specific to artists
+            # Also adds files with their paths specified in the artist sections
+            artistRules = self.getArtistRules(filePaths, excludePaths)
+
+            # Add any files with their paths specified in general section
+            # Also update the excluded paths for General
+            self.addSpecifiedFiles("General", filePaths, excludePaths, fileNames, excludeNames)
+
+            # Go through each file in general directories
+            if DIRS_KEY in self.sections["General"]:
+                # Resolve the valid directories up front, dropping any listed twice
+                directories = {}
+                for directory in self.parsedLists["General"][DIRS_KEY]:
+                    # Check that this is a valid directory
+                    if not os.path.isdir(directory):
+                        # Skip invalid directory
+                        print("error: invalid directory {}".format(directory))
                         continue
-
-                    # Determine artists if any and apply correct rules
-                    artists = self.getArtist(filePath)
-                    hadArtistRules = False
-                    for artist in artists:
-                        if artist in artistRules:
+                    directories[os.path.abspath(directory)] = None
+
+                # Walk the directories lazily, batches of files are handed to the pool as they come
+                # Artists can't change the outcome without artist rules, so only read tags if needed
+                # The writer's own path set is passed, so files added during the walk are still seen
+                candidates = collectCandidates(directories, filePaths.paths, excludePaths,
+                                               frozenset(excludeNames), bool(artistRules))
+
+                # Artists that have rules, to intersect with each file's artists
+                artistRuleKeys = artistRules.keys()
+
+                # Read artists in worker processes, applying rules here as results arrive in order
+                with ProcessPoolExecutor() as executor:
+                    for filename, filePath, artists in readCandidateArtists(executor, candidates):
+                        # Determine artists with rules if any and apply correct rules
+                        matched = artistRuleKeys & artists if artists else None
+                        if matched:
                             # We have specific rules for this file
-                            hadArtistRules = True
+                            # The first artist in the tag takes precedence over any others
+                            # @TODO should the rules of all matched artists be applied?
+                            if len(matched) == 1:
+                                artist = next(iter(matched))
+                            else:
+                                artist = next(artist for artist in artists if artist in matched)
                             self.processArtistRules(artistRules[artist], artist, filePaths,
                                                     filename, filePath)
-                            # @TODO is this break a good idea for multiple artist files?
-                            break
-
-                    # Apply general rules if no specific artist rules applied
-                    if not hadArtistRules:
-                        # @TODO implement ALL dir rules
-                        if filename in fileNames:
-                            # Filename is specified
-                            filePaths.add(filePath)
-
-                            # Remove from fileNames to keep track of files that haven't been added
-                            fileNames.remove(filename)
                         else:
-                            # File is not specified, add to random pile
-                            randomGeneral.append(filePath)
-
-        # Add random files
-        for artist in artistRules:
-            # Check if any random files are requested
-            if RANDOM_KEY not in self.config[artist]:
-                continue
-
-            # Add random files to filePaths
-            try:
-                nRandom = int(self.config[artist][RANDOM_KEY])
-            except Exception:
-                # Invalid random number
-                print("error: invalid number of random files for {}".format(artist))
-                continue
+                            # Apply general rules if no specific artist rules applied
+                            # @TODO implement ALL dir rules
+                            if filename in fileNames:
+                                # Filename is specified
+                                filePaths.add(filePath, filename)
+
+                                # Remove from fileNames to keep track of files that haven't been added
+                                fileNames.remove(filename)
+                            else:
+                                # File is not specified, add to random pile
+                                randomGeneral.append((filePath, filename))
+
+            # Add random files
+            for artist, rules in artistRules.items():
+                # Check if any random files are requested
+                if not rules.wantsRandom:
+                    continue
 
-            # @TODO handle issue where size of list being sampled is smaller than number of samples requested
-            # @TODO additional bug when only random is specified for an artist, no include/exclude
-            for filePath in random.sample(artistRules[artist]["random"], nRandom):
-                filePaths.add(filePath)
-                print("Adding random {}".format(filePath))
+                # Add random files to filePaths, no more than there are to choose from
+                # @TODO additional bug when only random is specified for an artist, no include/exclude
+                pool = rules.random
+                nRandom = max(0, min(rules.nRandom, len(pool)))
+                for filePath, fileName in self.rng.sample(pool, nRandom):
+                    filePaths.add(filePath, fileName)
+                    print("Adding random {}".format(filePath))
 
-        # Print missing files
-        for artist in artistRules:
-            if len(artistRules[artist]["fileNames"]) > 0:
-                for fileName in list(artistRules[artist]["fileNames"]):
-                    print("warning: missing {} from {}".format(fileName, artist))
+            # Print missing files
+            for artist, rules in artistRules.items():
+                if len(rules.fileNames) > 0:
+                    for fileName in list(rules.fileNames):
+                        print("warning: missing {} from {}".format(fileName, artist))
 
-        # Write file
-        self.writeToPlaylist(filePaths)
         print("Finished {}".format(self.configFile))
 
 